@@ -7,13 +7,19 @@ SPDX-FileCopyrightText: Patrik Schönfeldt
 SPDX-License-Identifier: MIT
 """
 
+import functools
 import logging
-import math
+import numbers
 import os
-import plotly.graph_objs as go
+import pathlib
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import graphviz
+    from graphviz.backend.rendering import get_format
+    from graphviz.quoting import a_list, attr_list, quote, quote_edge
 
     GRAPHVIZ_MODULE = True
 except ModuleNotFoundError:
@@ -42,12 +48,25 @@ try:
 except ModuleNotFoundError:
     GenericStorage = None
 
+# optional packages which are missing to plot a graph
+_MISSING_MODULES = []
+if NETWORK_MODULE is False:
+    _MISSING_MODULES.append("oemof.network")
+if GRAPHVIZ_MODULE is False:
+    _MISSING_MODULES.append("graphviz")
+
 COLOR_SOURCE = "#A4ADFB"
 COLOR_SINK = "#FFD6E0"
 COLOR_STORAGE = "#90F1EF"
 COLOR_CONVERTER = "#7BF1A8"
 
 
+@functools.lru_cache(maxsize=None)
+def _line_pattern(char_num):
+    """Return a compiled regex matching up to char_num characters"""
+    return re.compile(".{{1,{}}}".format(char_num), re.DOTALL)
+
+
 def fixed_width_text(text, char_num=10):
     """Add linebreaks every char_num characters in a given text.
 
@@ -74,15 +93,18 @@ def fixed_width_text(text, char_num=10):
     >>> fixed_width_text("", 2)
     ''
     """
-    # integer number of lines of `char_num` character
-    n_lines = math.ceil(len(text) / char_num)
-
     # split the text in lines of `char_num` character
-    split_text = []
-    for i in range(n_lines):
-        split_text.append(text[(i * char_num) : ((i + 1) * char_num)])
+    return "\n".join(_line_pattern(char_num).findall(text))
+
 
-    return "\n".join(split_text)
+def _add_node(dot, name, attrs):
+    """Append a node statement to the body of a graphviz graph
+
+    Equivalent to `dot.node(name, **attrs)`, without the overhead of the
+    graphviz wrapper which matters for large energy systems. The
+    attributes are expected already formatted with `attr_list`.
+    """
+    dot.body.append("\t{}{}\n".format(quote(name), attrs))
 
 
 class ESGraphRenderer:
@@ -133,15 +155,10 @@ class ESGraphRenderer:
         -------
         None: render the generated dot graph in the filepath
         """
-        missing_modules = []
-        if NETWORK_MODULE is False or GRAPHVIZ_MODULE is False:
-            if NETWORK_MODULE is False:
-                missing_modules.append("oemof.network")
-            if GRAPHVIZ_MODULE is False:
-                missing_modules.append("graphviz")
+        if _MISSING_MODULES:
             raise ModuleNotFoundError(
                 "You have to install the following packages to plot a graph\n"
-                "pip install {0}".format(" ".join(missing_modules))
+                "pip install {0}".format(" ".join(_MISSING_MODULES))
             )
 
         self.energy_system = energy_system
@@ -161,13 +178,123 @@ class ESGraphRenderer:
             else:
                 img_format = "pdf"
 
-        self.dot = graphviz.Digraph(format=img_format, **kwargs)
+        self._dot = graphviz.Digraph(format=img_format, **kwargs)
         self.txt_width = txt_width
         self.txt_fontsize = str(txt_fontsize)
-        self.busses = []
+        self.legend = legend
+
+        # attributes of the nodes of each component type, formatted once
+        self._bus_attrs = a_list(
+            kwargs=dict(
+                shape="rectangle",
+                fontsize="10",
+                fixedsize="shape",
+                width="4.1",
+                height="0.3",
+                style="filled",
+                color="lightgrey",
+            )
+        )
+        self._sink_attrs = attr_list(
+            kwargs=dict(
+                shape="trapezium",
+                color=COLOR_SINK,
+                fontsize=self.txt_fontsize,
+            )
+        )
+        self._source_attrs = attr_list(
+            kwargs=dict(
+                shape="invtrapezium",
+                color=COLOR_SOURCE,
+                fontsize=self.txt_fontsize,
+            )
+        )
+        self._transformer_attrs = attr_list(
+            kwargs=dict(
+                shape="rectangle",
+                color=COLOR_CONVERTER,
+                fontsize=self.txt_fontsize,
+            )
+        )
+        self._chp_attrs = attr_list(
+            kwargs=dict(
+                shape="rectangle",
+                fontsize=self.txt_fontsize,
+                style="filled",
+                fillcolor="yellow;0.1:blue",
+                # color="magenta",
+            )
+        )
+        self._storage_attrs = attr_list(
+            kwargs=dict(
+                shape="rectangle",
+                style="rounded",
+                color=COLOR_STORAGE,
+                fontsize=self.txt_fontsize,
+            )
+        )
+        self._component_attrs = attr_list(
+            kwargs=dict(fontsize=self.txt_fontsize)
+        )
 
-        if legend is True:
-            with self.dot.subgraph(name="cluster_1") as c:
+        # the graph is drawn from the nodes of the energy system at the time
+        # the renderer is created, even if it is built later
+        self._nodes = list(energy_system.nodes)
+        # keep the bus references for drawing edges later
+        self.busses = [
+            nd for nd in self._nodes if isinstance(nd, Bus)
+        ]  # TODO here get the info from inputs and outputs and adapt the labels
+        # wrapped labels, computed once per label and reused for the edges
+        self._label_cache = {}
+        # name of the graph node drawn for each oemof node, by id of the node,
+        # quoted for edge statements
+        self._node_names = {}
+
+        # drawing method for each of the supported component types, looked
+        # up by the exact type of a node, subclasses are added when met
+        self._dispatch = {
+            Bus: self.add_bus,
+            Sink: self.add_sink,
+            Source: self.add_source,
+            OffsetConverter: self.add_transformer,
+            GenericCHP: self.add_chp,
+            ExtractionTurbineCHP: self.add_chp,
+            Converter: self.add_transformer,
+            Transformer: self.add_transformer,
+            GenericStorage: self.add_storage,
+        }
+
+        # the graph is only built when it is first needed
+        self._built = False
+
+    @property
+    def dot(self):
+        """The graphviz.Digraph instance of the energy system
+
+        The graph is built on first access, so that creating a renderer
+        only to draw a sankey diagram does not pay for it. Assigning another
+        graphviz.Digraph replaces it.
+        """
+        if self._built is False:
+            n_lines = len(self._dot.body)
+            try:
+                self._build()
+            except Exception:
+                # drop the partly drawn graph, the next access starts over
+                del self._dot.body[n_lines:]
+                raise
+            self._built = True
+        return self._dot
+
+    @dot.setter
+    def dot(self, value):
+        self._dot = value
+        self._built = True
+
+    def _build(self):
+        """Draw the legend, the nodes and the edges of the energy system"""
+        if self.legend is True:
+            with self._dot.subgraph(name="cluster_1") as c:
                 # color of the legend box
                 c.attr(color="black")
                 # title of the legend box
@@ -180,32 +307,17 @@ class ESGraphRenderer:
 
         # draw a node for each of the energy_system's component.
         # the shape depends on the component's type.
-        for nd in energy_system.nodes:
-            # make sur the label is a string and not a tuple
-            label = str(nd.label)
-            if isinstance(nd, Bus):
-                self.add_bus(nd.label)
-                # keep the bus reference for drawing edges later
-                self.busses.append(
-                    nd
-                )  # TODO here get the info from inputs and outputs and adapt the labels
-            elif isinstance(nd, Sink):
-                self.add_sink(nd.label)
-            elif isinstance(nd, Source):
-                self.add_source(nd.label)
-            elif isinstance(nd, OffsetConverter):
-                self.add_transformer(nd.label)
-            elif isinstance(nd, GenericCHP):
-                self.add_chp(nd.label)
-            elif isinstance(nd, ExtractionTurbineCHP):
-                self.add_chp(nd.label)
-            elif isinstance(nd, Converter):
-                self.add_transformer(nd.label)
-            elif isinstance(nd, Transformer):
-                self.add_transformer(nd.label)
-            elif isinstance(nd, GenericStorage):
-                self.add_storage(nd.label)
-            else:
+        for nd in self._nodes:
+            # make sure the label is a string and not a tuple, without
+            # modifying the oemof node
+            label = nd.label
+            if label.__class__ is not str:
+                label = str(label)
+            try:
+                handler = self._dispatch[type(nd)]
+            except KeyError:
+                handler = self._slow_dispatch(type(nd))
+            if handler is None:
                 logging.warning(
                     "The oemof component {} of type {} is not implemented in "
                     "the rendering method of the energy model graph drawer. "
@@ -213,106 +325,116 @@ class ESGraphRenderer:
                         nd.label, type(nd)
                     )
                 )
-                self.add_component(nd.label)
+                handler = self.add_component
+            handler(label)
+            if handler == self.add_bus:
+                self._node_names[id(nd)] = quote_edge(label)
+            else:
+                self._node_names[id(nd)] = quote_edge(self._fmt(label))
 
         # draw the edges between the nodes based on each bus inputs/outputs
+        names = self._node_names
+        # nodes which are connected to a bus but not part of the energy
+        # system have no stored name
+        edge_name = self._edge_name
+        body = self._dot.body
+        # a flow between two buses is both an output of the first and an
+        # input of the second one, it is drawn from the inputs only
+        bus_ids = {id(bus) for bus in self.busses}
         for bus in self.busses:
-            for component in bus.inputs:
-                # draw an arrow from the component to the bus
-                self.connect(component, bus)
-            for component in bus.outputs:
-                # draw an arrow from the bus to the component
-                self.connect(bus, component)
+            bus_name = names[id(bus)]
+            # draw an arrow from each input component to the bus
+            body.extend(
+                "\t{} -> {}\n".format(edge_name(component), bus_name)
+                for component in bus.inputs
+            )
+            # draw an arrow from the bus to each output component
+            body.extend(
+                "\t{} -> {}\n".format(bus_name, edge_name(component))
+                for component in bus.outputs
+                if id(component) not in bus_ids
+            )
+
+    def _slow_dispatch(self, cls):
+        """Return the drawing method of a node type which is not a key of
+        the dispatch table, None if the type is not supported
+
+        The method of the closest supported parent class is used and stored
+        in the dispatch table, so the lookup is done once per node type.
+        """
+        handler = None
+        for parent in cls.__mro__:
+            if parent in self._dispatch:
+                handler = self._dispatch[parent]
+                break
+        self._dispatch[cls] = handler
+        return handler
+
+    def _fmt(self, label):
+        """Return the label with line breaks, see `fixed_width_text`
+
+        The result is cached, as the same label is used for the node and for
+        each of its edges.
+        """
+        try:
+            return self._label_cache[label]
+        except KeyError:
+            text = fixed_width_text(label, char_num=self.txt_width)
+            self._label_cache[label] = text
+            return text
 
     def add_bus(self, label="Bus", subgraph=None):
         if subgraph is None:
-            dot = self.dot
+            dot = self._dot
         else:
             dot = subgraph
-        dot.node(
+        _add_node(
+            dot,
             label,
-            shape="rectangle",
-            fontsize="10",
-            fixedsize="shape",
-            width="4.1",
-            height="0.3",
-            style="filled",
-            color="lightgrey",
-            tooltip=label,
+            " [{} tooltip={}]".format(self._bus_attrs, quote(label)),
         )
 
     def add_sink(self, label="Sink", subgraph=None):
         if subgraph is None:
-            dot = self.dot
+            dot = self._dot
         else:
             dot = subgraph
-        dot.node(
-            fixed_width_text(label, char_num=self.txt_width),
-            shape="trapezium",
-            color=COLOR_SINK,
-            fontsize=self.txt_fontsize,
-        )
+        _add_node(dot, self._fmt(label), self._sink_attrs)
 
     def add_source(self, label="Source", subgraph=None):
         if subgraph is None:
-            dot = self.dot
+            dot = self._dot
         else:
             dot = subgraph
-        dot.node(
-            fixed_width_text(label, char_num=self.txt_width),
-            shape="invtrapezium",
-            color=COLOR_SOURCE,
-            fontsize=self.txt_fontsize,
-        )
+        _add_node(dot, self._fmt(label), self._source_attrs)
 
     def add_transformer(self, label="Transformer", subgraph=None):
         if subgraph is None:
-            dot = self.dot
+            dot = self._dot
         else:
             dot = subgraph
-        dot.node(
-            fixed_width_text(label, char_num=self.txt_width),
-            shape="rectangle",
-            color=COLOR_CONVERTER,
-            fontsize=self.txt_fontsize,
-        )
+        _add_node(dot, self._fmt(label), self._transformer_attrs)
 
     def add_chp(self, label="CHP", subgraph=None):
         if subgraph is None:
-            dot = self.dot
+            dot = self._dot
         else:
             dot = subgraph
-        dot.node(
-            fixed_width_text(label, char_num=self.txt_width),
-            shape="rectangle",
-            fontsize=self.txt_fontsize,
-            style="filled",
-            fillcolor="yellow;0.1:blue",
-            # color="magenta",
-        )
+        _add_node(dot, self._fmt(label), self._chp_attrs)
 
     def add_storage(self, label="Storage", subgraph=None):
         if subgraph is None:
-            dot = self.dot
+            dot = self._dot
         else:
             dot = subgraph
-        dot.node(
-            fixed_width_text(label, char_num=self.txt_width),
-            shape="rectangle",
-            style="rounded",
-            color=COLOR_STORAGE,
-            fontsize=self.txt_fontsize,
-        )
+        _add_node(dot, self._fmt(label), self._storage_attrs)
 
     def add_component(self, label="component", subgraph=None):
         if subgraph is None:
-            dot = self.dot
+            dot = self._dot
         else:
             dot = subgraph
-        dot.node(
-            fixed_width_text(label, char_num=self.txt_width),
-            fontsize=self.txt_fontsize,
-        )
+        _add_node(dot, self._fmt(label), self._component_attrs)
 
     def connect(self, a, b):
         """Draw an arrow from node a to node b
@@ -325,38 +447,186 @@ class ESGraphRenderer:
         b: `oemof.solph.network.Node`
             An oemof node (usually a Bus or a Component)
         """
-        if not isinstance(a, Bus):
-            a = fixed_width_text(a.label, char_num=self.txt_width)
-        else:
-            a = a.label
-        if not isinstance(b, Bus):
-            b = fixed_width_text(b.label, char_num=self.txt_width)
-        else:
-            b = b.label
+        self._dot.body.append(
+            "\t{} -> {}\n".format(self._edge_name(a), self._edge_name(b))
+        )
 
-        self.dot.edge(a, b)
+    def _edge_name(self, nd):
+        """Return the name of the graph node of nd, quoted for an edge
+
+        The name stored when drawing the node is reused if there is one.
+        """
+        try:
+            return self._node_names[id(nd)]
+        except KeyError:
+            label = str(nd.label)
+            if isinstance(nd, Bus):
+                return quote_edge(label)
+            return quote_edge(self._fmt(label))
 
     def view(self, **kwargs):
         """Call the view method of the DiGraph instance"""
         self.dot.view(**kwargs)
 
-    def render(self, **kwargs):
-        """Call the render method of the DiGraph instance"""
-        print(self.dot.render(**kwargs))
+    def render(self, verbose=False, **kwargs):
+        """Call the render method of the DiGraph instance
+
+        If only `outfile` (and optionally `format`) is provided, the graph
+        is piped through graphviz and the image is written to `outfile`
+        without saving the intermediate source file.
+
+        The path of the rendered file is logged at debug level, or printed
+        if `verbose` is True.
+        """
+        if "outfile" in kwargs and set(kwargs) <= {"outfile", "format"}:
+            path = self._pipe_render(kwargs["outfile"], kwargs.get("format"))
+        else:
+            path = self.dot.render(**kwargs)
+        if verbose is True:
+            print(path)
+        else:
+            logging.debug("Energy system graph rendered in {}".format(path))
         return self.dot
 
+    def _pipe_render(self, outfile, img_format=None):
+        """Write the image of the graph to outfile and return its path
+
+        As with `graphviz.Digraph.render`, outfile is relative to the
+        directory of the graph and the image format is inferred from its
+        extension if img_format is not provided.
+        """
+        # check the format against the extension the way graphviz does
+        img_format = get_format(pathlib.Path(outfile), format=img_format)
+        outfile = os.path.join(self.dot.directory, outfile)
+        out_dir = os.path.dirname(outfile)
+        if out_dir != "":
+            os.makedirs(out_dir, exist_ok=True)
+        with open(outfile, "wb") as f:
+            f.write(self.dot.pipe(format=img_format))
+        return outfile
+
+    def render_formats(
+        self, formats, renderer=None, formatter=None, verbose=False
+    ):
+        """Render the graph in several image formats with one graphviz call
+
+        The source is saved once and graphviz writes one image per format
+        next to it, named after the source file as by the render method.
+
+        Parameters
+        ----------
+        formats: list of str
+            extensions of the image formats of graphviz (e.g "png", "svg",
+            "pdf", ... )
+
+        renderer: str
+            output renderer of graphviz (e.g "cairo", "gd", ... ) used for
+            all formats
+            Default: None
+
+        formatter: str
+            output formatter of graphviz (e.g "cairo", "gd", ... ), requires
+            a renderer
+            Default: None
+
+        verbose: bool
+            print the paths of the rendered files instead of logging them
+            Default: False
+
+        Returns
+        -------
+        list of str: the paths of the rendered files, one per format
+        """
+        if formatter is not None and renderer is None:
+            raise graphviz.RequiredArgumentError(
+                "formatter given without renderer"
+            )
+        # appended to each format in the -T options of graphviz
+        output_options = [o for o in (renderer, formatter) if o is not None]
+
+        source_path = self.dot.save()
+        # graphviz runs the layout engine of the graph through dot
+        cmd = (
+            ["dot", "-K{}".format(self.dot.engine)]
+            + [
+                "-T{}".format(":".join([img_format] + output_options))
+                for img_format in formats
+            ]
+            + ["-O", source_path]
+        )
+        try:
+            subprocess.run(cmd, check=True)
+        except FileNotFoundError as e:
+            raise graphviz.ExecutableNotFound(cmd) from e
+        except subprocess.CalledProcessError as e:
+            raise graphviz.CalledProcessError(
+                e.returncode, e.cmd, output=e.output, stderr=e.stderr
+            ) from e
+        # the rendered files are named source.[formatter.]renderer.format
+        paths = [
+            ".".join([source_path] + output_options[::-1] + [img_format])
+            for img_format in formats
+        ]
+        for path in paths:
+            if verbose is True:
+                print(path)
+            else:
+                logging.debug(
+                    "Energy system graph rendered in {}".format(path)
+                )
+        return paths
+
+    @staticmethod
+    def render_many(renderers, max_workers=None, **kwargs):
+        """Render several energy system graphs in parallel
+
+        Graphviz lays out each graph in its own process, so the renders are
+        run from a pool of threads.
+
+        Parameters
+        ----------
+        renderers: list of `ESGraphRenderer`
+            the renderers of the graphs, each with its own filepath
+
+        max_workers: int
+            max number of graphs rendered at the same time
+            Default: chosen by `concurrent.futures.ThreadPoolExecutor`
+
+        **kwargs: various
+            optional arguments of the `render` method
+
+        Returns
+        -------
+        list of graphviz.Digraph: the rendered graphs
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda r: r.render(**kwargs), renderers))
+
     def pipe(self, **kwargs):
         """Call the pipe method of the DiGraph instance"""
-        self.dot.pipe(**kwargs)
+        return self.dot.pipe(**kwargs)
 
     def sankey(self, results, ts=None):
         """Return a dict to a plotly sankey diagram"""
+        # plotly is slow to import and only needed here
+        import plotly.graph_objs as go
+
         busses = []
 
         labels = []
         sources = []
         targets = []
         values = []
+        # position of each label in labels
+        label_idx = {}
+
+        def label_index(label):
+            """Return the position of label in labels, append it if new"""
+            idx = label_idx.get(label)
+            if idx is None:
+                idx = label_idx[label] = len(labels)
+                labels.append(label)
+            return idx
 
         # bus_data.update({bus: solph.views.node(results_main, bus)})
 
@@ -371,36 +641,33 @@ class ESGraphRenderer:
 
                 bus_label = bus.label
 
-                labels.append(nd.label)
+                bus_idx = label_index(bus_label)
 
                 flows = view_node(results, bus_label)["sequences"]
+                # total (or value at ts) of each flow of the bus at once
+                if ts is None:
+                    flow_values = flows.sum()
+                elif isinstance(ts, numbers.Integral):
+                    flow_values = flows.iloc[ts]
+                else:
+                    flow_values = flows.loc[ts]
 
                 # draw an arrow from the component to the bus
                 for component in bus.inputs:
-                    if component.label not in labels:
-                        labels.append(component.label)
+                    sources.append(label_index(component.label))
+                    targets.append(bus_idx)
 
-                    sources.append(labels.index(component.label))
-                    targets.append(labels.index(bus_label))
-
-                    val = flows[((component.label, bus_label), "flow")].sum()
-                    if ts is not None:
-                        val = flows[((component.label, bus_label), "flow")][ts]
+                    val = flow_values[((component.label, bus_label), "flow")]
                     # if val == 0:
                     #     val = 1
                     values.append(val)
 
                 for component in bus.outputs:
                     # draw an arrow from the bus to the component
-                    if component.label not in labels:
-                        labels.append(component.label)
-
-                    sources.append(labels.index(bus_label))
-                    targets.append(labels.index(component.label))
+                    sources.append(bus_idx)
+                    targets.append(label_index(component.label))
 
-                    val = flows[((bus_label, component.label), "flow")].sum()
-                    if ts is not None:
-                        val = flows[((bus_label, component.label), "flow")][ts]
+                    val = flow_values[((bus_label, component.label), "flow")]
                     # if val == 0:
                     #     val = 1
                     values.append(val)
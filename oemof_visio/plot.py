@@ -1,6 +1,5 @@
 import logging
 import pandas as pd
-import matplotlib.pyplot as plt
 
 
 def slice_df(df, date_from=None, date_to=None):
@@ -20,6 +19,8 @@ def slice_df(df, date_from=None, date_to=None):
     pandas.DataFrame
 
     """
+    if date_from is None and date_to is None:
+        return df
     if date_from is None:
         date_from = df.index[0]
     if date_to is None:
@@ -49,15 +50,19 @@ def rearrange_df(df, order, quiet=False):
     Columns that are not in the order list will be removed.
     """
 
-    cols = list(df.columns.values)
-    neworder = [x for x in list(order) if x in set(cols)]
-    missing = [x for x in list(cols) if x not in set(order)]
-    if len(missing) > 0 and not quiet:
-        logging.warning(
-            "Columns that are not part of the order list are removed: "
-            + str(missing)
-        )
-    return df[neworder]
+    cols = df.columns
+    order = list(order)
+    cols_set = set(cols)
+    neworder = [x for x in order if x in cols_set]
+    if not quiet:
+        order_set = set(order)
+        missing = [x for x in cols if x not in order_set]
+        if len(missing) > 0:
+            logging.warning(
+                "Columns that are not part of the order list are removed: "
+                + str(missing)
+            )
+    return df.loc[:, neworder]
 
 
 def color_from_dict(colordict, df):
@@ -78,8 +83,10 @@ def color_from_dict(colordict, df):
     list
         Containing the colors of all components of the subset attribute
     """
-    tmplist = list(map(colordict.get, list(df.columns)))
-    tmplist = ["#ff00f0" if v is None else v for v in tmplist]
+    tmplist = []
+    for col in df.columns:
+        color = colordict.get(col)
+        tmplist.append("#ff00f0" if color is None else color)
     if len(tmplist) == 1:
         colorlist = tmplist[0]
     else:
@@ -125,22 +132,28 @@ def set_datetime_ticks(
         If set to True unused space on the x-axis will be avoided
         (experimental).
     """
+    n_dates = len(dates)
     if tick_distance is None:
-        tick_distance = int(len(dates) / number_autoticks) - 1
-
-    ax.set_xticks(
-        range(0 + offset, len(dates) - 1, tick_distance), minor=False
-    )
+        tick_distance = int(n_dates / number_autoticks) - 1
+
+    ax.set_xticks(range(0 + offset, n_dates - 1, tick_distance), minor=False)
+    tick_dates = dates[0 + offset : n_dates - 1 : tick_distance]
+    dtype = getattr(tick_dates, "dtype", None)
+    if dtype is not None and dtype.kind == "M":
+        # datetime64 values, e.g. of a numpy array, have no strftime and are
+        # formatted at once through a DatetimeIndex
+        tick_labels = (
+            pd.DatetimeIndex(tick_dates).strftime(date_format).tolist()
+        )
+    else:
+        tick_labels = [item.strftime(date_format) for item in tick_dates]
     ax.set_xticklabels(
-        [
-            item.strftime(date_format)
-            for item in dates.tolist()[0 + offset :: tick_distance]
-        ],
+        tick_labels,
         rotation=0,
         minor=False,
     )
     if tight:
-        ax.set_xlim(0, int(len(dates)))
+        ax.set_xlim(0, n_dates)
     return ax
 
 
@@ -159,14 +172,16 @@ def divide_bus_columns(bus_label, columns):
     -------
 
     """
-    return {
-        "in_cols": [
-            c for c in columns if (len(c[0]) > 1 and c[0][1] == bus_label)
-        ],
-        "out_cols": [
-            c for c in columns if (len(c[0]) > 1 and c[0][0] == bus_label)
-        ],
-    }
+    in_cols = []
+    out_cols = []
+    for c in columns:
+        flow = c[0]
+        if len(flow) > 1:
+            if flow[1] == bus_label:
+                in_cols.append(c)
+            if flow[0] == bus_label:
+                out_cols.append(c)
+    return {"in_cols": in_cols, "out_cols": out_cols}
 
 
 def io_plot(
@@ -245,26 +260,24 @@ def io_plot(
         area_kwa = {}
 
     if ax is None:
+        # pyplot is slow to import, only load it when a figure is needed
+        import matplotlib.pyplot as plt
+
         fig = plt.figure()
         ax = fig.add_subplot(1, 1, 1)
 
-    if df_in is not None:
-        df_in = df_in.copy()
-    if df_out is not None:
-        df_out = df_out.copy()
-
     if df is not None:
         divided_columns = divide_bus_columns(bus_label, df.columns)
         in_cols = divided_columns["in_cols"]
         out_cols = divided_columns["out_cols"]
-        df_in = df[in_cols].copy()
-        df_out = df[out_cols].copy()
+        df_in = df[in_cols]
+        df_out = df[out_cols]
 
     # Create a bar (or area) plot for all input flows
     if inorder is not None:
         df_in = rearrange_df(df_in, inorder)
     else:
-        df_in.sort_index(axis=1, ascending=True, inplace=True)
+        df_in = df_in.sort_index(axis=1, ascending=True)
 
     df_in = df_in.reset_index(drop=True)
 
@@ -297,24 +310,14 @@ def io_plot(
     if outorder is not None:
         df_out = rearrange_df(df_out, outorder)
     else:
-        df_out.sort_index(axis=1, ascending=True, inplace=True)
+        df_out = df_out.sort_index(axis=1, ascending=True)
 
     df_out = df_out.reset_index(drop=True)
 
     # The following changes are made to have the bottom line on top layer
     # of all lines. Normally the bottom line is the first line that is
     # plotted and will be on the lowest layer. This is difficult to read.
-    new_df = pd.DataFrame(index=df_out.index)
-    tmp = 0
-    for col in df_out.columns:
-        new_df[col] = df_out[col] + tmp
-        tmp = new_df[col]
-    if outorder is None:
-        new_df.sort_index(axis=1, ascending=False, inplace=True)
-    else:
-        lineorder = list(outorder)
-        lineorder.reverse()
-        new_df = new_df[lineorder]
+    new_df = df_out.cumsum(axis=1).iloc[:, ::-1]
 
     if cdict is not None:
         colorlist = color_from_dict(cdict, df_out)
@@ -339,12 +342,10 @@ def io_plot(
 
     # Adapt the legend to the new order
     handles, labels = ax.get_legend_handles_labels()
-    tmp_lab = [x for x in reversed(labels[0:separator])]
-    tmp_hand = [x for x in reversed(handles[0:separator])]
-    handles = tmp_hand + handles[separator:]
-    labels = tmp_lab + labels[separator:]
-    labels.reverse()
-    handles.reverse()
+    # reversing the first `separator` entries and then the whole list is
+    # the same as moving the reversed remainder in front of them
+    handles = handles[separator:][::-1] + handles[:separator]
+    labels = labels[separator:][::-1] + labels[:separator]
 
     ax.legend(handles, labels)
 